@@ -20,16 +20,119 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import random, serial
-from time import sleep
-
-class BusPirate:
-	def __init__(self, device, baud, timeout=0.1):
-		self.device = device
-		self.baud = baud
-		self.serial = serial.Serial(self.device, self.baud)
-		self.timeout = timeout
+import collections, contextlib, ctypes, json, os, random, re, serial, struct
+from time import sleep, time
+
+try:
+	import termios
+	# pyserial lets errors of the tty layer through on POSIX systems
+	SERIAL_ERRORS = (serial.SerialException, OSError, termios.error)
+except ImportError:
+	SERIAL_ERRORS = (serial.SerialException, OSError)
+
+class BusPirateRecorder:
+	# Trace file layout: MAGIC, then records starting with a one byte type
+	#   b'T' <id:u8> <len:u8> <name>                         operation tag definition
+	#   b'W' <id:u8> <start:u64> <duration:u32> <len:u32> <data>  transport write, times in us
+	MAGIC = b'BPTR\x01'
+
+	def __init__(self, path):
+		self.file = open(path, 'wb')
+		self.file.write(BusPirateRecorder.MAGIC)
+		self.start = time()
+		self.tags = {}
+
+	def record(self, operation, data, start, end):
+		if operation not in self.tags:
+			tag = operation.encode('utf-8')
+			self.tags[operation] = len(self.tags)
+			self.file.write(b'T' + struct.pack('<BB', self.tags[operation], len(tag)) + tag)
+
+		self.file.write(b'W' + struct.pack('<BQII',
+			self.tags[operation],
+			int((start - self.start)*1000000),
+			int((end - start)*1000000),
+			len(data)))
+		self.file.write(data)
+
+	def close(self):
+		self.file.close()
+
+class BusPirateTrace:
+	def __init__(self, path):
+		self.path = path
+
+	def __iter__(self):
+		with open(self.path, 'rb') as f:
+			if f.read(len(BusPirateRecorder.MAGIC)) != BusPirateRecorder.MAGIC:
+				raise ValueError('%s is not a bus pirate trace' % (self.path))
+
+			tags = {}
+			while True:
+				kind = f.read(1)
+				if kind == b'':
+					break
+				elif kind == b'T':
+					tag, length = struct.unpack('<BB', f.read(2))
+					tags[tag] = f.read(length).decode('utf-8')
+				elif kind == b'W':
+					tag, start, duration, length = struct.unpack('<BQII', f.read(17))
+					yield (tags[tag], start/1000000.0, duration/1000000.0, f.read(length))
+				else:
+					raise ValueError('Unknown record type %r in %s' % (kind, self.path))
+
+	def replay(self, target, realtime=False):
+		written = 0
+		begin = time()
+		for (operation, start, duration, data) in self:
+			if realtime:
+				sleep(max(0, start - (time() - begin)))
+			target.write(data)
+			written += len(data)
+
+		if hasattr(target, 'flush'):
+			target.flush()
+
+		return (written, time() - begin)
+
+	def analyze(self):
+		stats = {}
+		last = None
+		previous = None
+		for (operation, start, duration, data) in self:
+			if operation not in stats:
+				stats[operation] = {'bytes': 0, 'transactions': 0, 'busy': 0.0, 'idle': 0.0}
+			s = stats[operation]
+			s['bytes'] += len(data)
+			s['transactions'] += 1
+			s['busy'] += duration
+
+			# gaps between different operations belong to the application
+			if previous == operation:
+				s['idle'] += max(0.0, start - last)
+			last = start + duration
+			previous = operation
+		return stats
+
+	def report(self):
+		lines = ['%-12s %10s %12s %10s %10s' % ('operation', 'bytes', 'transactions', 'busy [s]', 'idle [s]')]
+		for (operation, s) in sorted(self.analyze().items()):
+			lines += ['%-12s %10i %12i %10.3f %10.3f' % (operation, s['bytes'], s['transactions'], s['busy'], s['idle'])]
+		return '\n'.join(lines)
+
+class Transport:
+	# Interface between the display logic and the bus the panel is wired to.
+	# Writes inside an operation may be queued until the outermost operation
+	# ends, outside of an operation they are flushed immediately.
+	def __init__(self):
 		self.debugMode = False
+		self.recorder = None
+		self.operations = []
+		self.onReattach = None
+		self.bytes_written = 0
+
+		# largest data transfer sync() hands to write_data()
+		self.block_size = 16
 
 	def debug(self, msg):
 		if self.debugMode:
@@ -38,13 +141,172 @@ class BusPirate:
 	def setDebugMode(self, enable=True):
 		self.debugMode = enable
 
+	def setRecorder(self, recorder):
+		self.recorder = recorder
+
+	def record(self, data, start):
+		self.bytes_written += len(data)
+		if self.recorder != None:
+			self.recorder.record(self.getOperation(), data, start, time())
+
+	@contextlib.contextmanager
+	def operation(self, operation):
+		# the outermost operation flushes the queued writes, or drops them
+		# if the operation failed
+		self.operations.append(operation)
+		try:
+			yield
+			if len(self.operations) == 1:
+				self.flush()
+		except BaseException:
+			if len(self.operations) == 1:
+				self.discard()
+			raise
+		finally:
+			self.operations.pop()
+
+	def getOperation(self):
+		if len(self.operations) == 0:
+			return 'other'
+		return self.operations[-1]
+
+	def init(self):
+		pass
+
+	def reattach(self):
+		# returns True if the session on the bus survived
+		return True
+
+	def write_cmds(self, commands):
+		raise NotImplementedError()
+
+	def write_data(self, data):
+		raise NotImplementedError()
+
+	def flush(self):
+		pass
+
+	def discard(self):
+		pass
+
+class BusPirate(Transport):
+	# prompt of the Bus Pirate while the protocol is active
+	MODE = None
+
+	def __init__(self, device, baud, timeout=0.1):
+		Transport.__init__(self)
+		self.device = device
+		self.baud = baud
+		self.timeout = timeout
+
+		self.autoReconnect = True
+		self.reconnectAttempts = 10
+		self.reconnectDelay = 0.5
+		self.reconnecting = False
+
+		self.open()
+
+	def open(self):
+		# reads only wait for the prompt of the Bus Pirate, see waitPrompt()
+		self.serial = serial.Serial(self.device, self.baud, timeout=1.0)
+
+	def waitPrompt(self):
+		# the prompt follows once the Bus Pirate has processed the line
+		prompt = b'%s>' % (self.MODE.encode('ascii'))
+		if not self.serial.read_until(prompt).endswith(prompt):
+			self.debug('bus pirate: no prompt within %.1fs' % (self.serial.timeout))
+
+	def write(self, data):
+		self.transfer(data)
+
+	def transfer(self, data, reply=None):
+		# a link which breaks while the reply is read is lost as well, the
+		# whole exchange is repeated after a reconnect
+		start = time()
+		try:
+			response = self.exchange(data, reply)
+		except SERIAL_ERRORS:
+			if not self.autoReconnect or self.reconnecting:
+				raise
+			self.reconnect()
+			response = self.exchange(data, reply)
+		self.record(data, start)
+		return response
+
+	def exchange(self, data, reply):
+		if reply == None:
+			self.serial.write(data)
+			return None
+
+		self.serial.reset_input_buffer()
+		self.serial.write(data)
+		return reply()
+
+	def readPending(self):
+		sleep(self.timeout)
+		return self.serial.read(self.serial.in_waiting)
+
 	def command(self, command):
 		self.debug('bus pirate: %s' % (command))
-		self.serial.write(b'%s\r' % (command))
+		self.write(b'%s\r' % (command))
 		sleep(self.timeout)
 
-	def init(self):
-		pass
+	def encode(self, data):
+		# runs of a value are sent with the repeat syntax of the Bus Pirate
+		d = b''
+		idx = 0
+		while idx < len(data):
+			i = data[idx]
+			if type(i) != int:
+				d += bytes(i, 'utf-8') + b' '
+				idx += 1
+				continue
+
+			n = 1
+			while idx+n < len(data) and data[idx+n] == i:
+				n += 1
+			if n > 2:
+				d += b'0x%2.2X:%i ' % (i, n)
+			else:
+				d += b'0x%2.2X ' % (i) * n
+			idx += n
+		return d
+
+	def reconnect(self):
+		self.debug('bus pirate: reconnecting to %s' % (self.device))
+		self.reconnecting = True
+		try:
+			with self.operation('reconnect'):
+				for attempt in range(self.reconnectAttempts):
+					try:
+						self.serial.close()
+						self.open()
+						kept = self.reattach()
+						break
+					except SERIAL_ERRORS:
+						if attempt == self.reconnectAttempts-1:
+							raise
+						sleep(self.reconnectDelay)
+				if self.onReattach != None:
+					self.onReattach(kept)
+		finally:
+			self.reconnecting = False
+
+	def reattach(self):
+		if self.MODE == None or self.getMode() == self.MODE:
+			self.debug('bus pirate: still in %s mode' % (self.MODE))
+			return True
+
+		self.init()
+		return False
+
+	def getMode(self):
+		response = self.transfer(b'\r', self.readPending).decode('ascii', 'replace')
+
+		prompts = re.findall(r'([0-9A-Za-z-]+)>', response)
+		if len(prompts) == 0:
+			return None
+		return prompts[-1]
 
 	def setProtocol(self, protocol):
 		self.command(b'm')
@@ -57,6 +319,8 @@ class BusPirate:
 		self.command(b'P')
 
 class BusPirateI2C(BusPirate):
+	MODE = 'I2C'
+
 	def __init__(self, device, baud, i2c_addr, i2c_freq=1, i2c_timeout=0.01):
 		BusPirate.__init__(self, device=device, baud=baud)
 		self.i2c_address = i2c_addr
@@ -71,22 +335,174 @@ class BusPirateI2C(BusPirate):
 
 	def i2c_write(self, data, timeout=None):
 		d = b'[ 0x%2.2X ' % (self.i2c_address)
-		for i in data:
-			if type(i) == int:
-				d += b'0x%2.2X ' % (i)
-			else:
-				d += bytes(i, 'utf-8')
+		d += self.encode(data)
 		d += b']'
 
 		self.debug('i2c write: %s' % (d))
-		self.serial.write(d+b'\r')
+		self.write(d+b'\r')
 		if timeout == None:
 			sleep(self.timeout)
 		else:
 			sleep(timeout)
 
+	def write_cmds(self, commands):
+		self.i2c_write([0x00] + commands)
 
-class BusPirateSSD1306(BusPirateI2C):
+	def write_data(self, data):
+		self.i2c_write([0x40] + data)
+
+class BusPirateSPI(BusPirate):
+	# D/C of the display is wired to AUX, /CS to CS of the Bus Pirate
+	MODE = 'SPI'
+
+	def __init__(self, device, baud, spi_speed=4):
+		BusPirate.__init__(self, device=device, baud=baud)
+		self.spi_speed = spi_speed
+		self.block_size = 256
+
+	def init(self):
+		self.setProtocol(5)
+		self.command(b'%i' % (self.spi_speed))
+		self.command(b'1')	# clock idle low
+		self.command(b'2')	# output on active to idle edge
+		self.command(b'1')	# sample in the middle
+		self.command(b'2')	# /CS
+		self.command(b'2')	# normal outputs
+		self.enablePowerSupply()
+
+	def spi_write(self, data, dc):
+		d = b'%s[ ' % (b'A' if dc else b'a')
+		d += self.encode(data)
+		d += b']'
+
+		# instead of sleeping a fixed time per transfer the reply is awaited,
+		# a transfer takes as long as the serial link needs for it
+		self.debug('spi write: %s' % (d))
+		self.transfer(d+b'\r', self.waitPrompt)
+
+	def write_cmds(self, commands):
+		self.spi_write(commands, False)
+
+	def write_data(self, data):
+		self.spi_write(data, True)
+
+class i2c_msg(ctypes.Structure):
+	_fields_ = [
+		('addr', ctypes.c_uint16),
+		('flags', ctypes.c_uint16),
+		('len', ctypes.c_uint16),
+		('buf', ctypes.POINTER(ctypes.c_uint8))]
+
+class i2c_rdwr_ioctl_data(ctypes.Structure):
+	_fields_ = [
+		('msgs', ctypes.POINTER(i2c_msg)),
+		('nmsgs', ctypes.c_uint32)]
+
+class LinuxI2C(Transport):
+	# ioctls of linux/i2c-dev.h
+	I2C_SLAVE = 0x0703
+	I2C_RDWR = 0x0707
+	I2C_RDWR_MAX_MSGS = 42
+
+	def __init__(self, bus=1, i2c_addr=0x3C, fd=None, rdwr=None, max_transfer=4096):
+		Transport.__init__(self)
+		self.i2c_address = i2c_addr
+		self.max_transfer = max_transfer
+		self.block_size = max_transfer-1
+		self.pending = []
+
+		if fd == None:
+			import fcntl
+			self.device = '/dev/i2c-%i' % (bus)
+			fd = os.open(self.device, os.O_RDWR)
+			fcntl.ioctl(fd, LinuxI2C.I2C_SLAVE, i2c_addr)
+			if rdwr == None:
+				rdwr = True
+		self.fd = fd
+		self.rdwr = rdwr == True
+
+	def close(self):
+		os.close(self.fd)
+
+	def queue(self, control, data):
+		# consecutive transfers of the same kind are merged into one message
+		if len(self.pending) > 0 and self.pending[-1][0] == control and len(self.pending[-1])+len(data) <= self.max_transfer:
+			self.pending[-1] += bytes(data)
+		else:
+			self.pending += [bytearray([control]) + bytes(data)]
+
+		if len(self.operations) == 0:
+			self.flush()
+
+	def write_cmds(self, commands):
+		self.queue(0x00, commands)
+
+	def write_data(self, data):
+		for idx in range(0, len(data), self.max_transfer-1):
+			self.queue(0x40, data[idx:idx+self.max_transfer-1])
+
+	def discard(self):
+		self.pending = []
+
+	def flush(self):
+		pending = self.pending
+		self.pending = []
+		if len(pending) == 0:
+			return
+
+		self.debug('i2c-dev: %i messages, %i bytes' % (len(pending), sum(len(m) for m in pending)))
+		if not self.rdwr:
+			for m in pending:
+				start = time()
+				os.write(self.fd, m)
+				self.record(bytes(m), start)
+			return
+
+		import fcntl
+		for idx in range(0, len(pending), LinuxI2C.I2C_RDWR_MAX_MSGS):
+			chunk = pending[idx:idx+LinuxI2C.I2C_RDWR_MAX_MSGS]
+			buffers = [(ctypes.c_uint8*len(m)).from_buffer(m) for m in chunk]
+			msgs = (i2c_msg*len(chunk))()
+			for (msg, buf) in zip(msgs, buffers):
+				msg.addr = self.i2c_address
+				msg.flags = 0
+				msg.len = len(buf)
+				msg.buf = ctypes.cast(buf, ctypes.POINTER(ctypes.c_uint8))
+
+			start = time()
+			fcntl.ioctl(self.fd, LinuxI2C.I2C_RDWR, i2c_rdwr_ioctl_data(msgs, len(chunk)))
+			self.record(b''.join(bytes(m) for m in chunk), start)
+
+class Sprite:
+	# Bitmap in the page format of the display, either a list of columns one
+	# page high or a list of pages. The 8 vertical shifts are prepared once,
+	# a shifted sprite straddles one page more than the bitmap.
+	def __init__(self, bitmap):
+		if len(bitmap) > 0 and type(bitmap[0]) == int:
+			bitmap = [bitmap]
+		self.pages = [list(page) for page in bitmap]
+		self.width = len(self.pages[0])
+		self.height = len(self.pages)*8
+
+		self.shifted = []
+		self.masks = []
+		for shift in range(0, 8):
+			rows = [[0x00]*self.width for i in range(0, len(self.pages)+1)]
+			masks = [0x00]*(len(self.pages)+1)
+			for (p, page) in enumerate(self.pages):
+				for (x, column) in enumerate(page):
+					rows[p][x] |= (column << shift) & 0xFF
+					rows[p+1][x] |= column >> (8-shift)
+				masks[p] |= (0xFF << shift) & 0xFF
+				masks[p+1] |= 0xFF >> (8-shift)
+
+			if shift == 0:
+				rows = rows[:-1]
+				masks = masks[:-1]
+			self.shifted += [rows]
+			self.masks += [masks]
+
+class BusPirateSSD1306:
 	# Documentation of SSD1306 https://cdn-shop.adafruit.com/datasheets/SSD1306.pdf#page=37&zoom=auto,0,842
 		
 	MEM_ADDR_MODE_PAGE = 0x10
@@ -612,68 +1028,140 @@ class BusPirateSSD1306(BusPirateI2C):
 		[0x00,0x00,0x00,0x00,0x00,0x00,0x00,0x00]	# 0xFF
 	];
 
-	def __init__(self, device, baud, i2c_addr=0x78, i2c_freq=4, width=128, height=64):
-		BusPirateI2C.__init__(self, device=device, baud=baud, i2c_addr=i2c_addr, i2c_freq=i2c_freq)
+	def __init__(self, device=None, baud=115200, i2c_addr=0x78, i2c_freq=4, width=128, height=64, state_file=None, bus=None):
+		if bus == None:
+			bus = BusPirateI2C(device=device, baud=baud, i2c_addr=i2c_addr, i2c_freq=i2c_freq)
+		self.bus = bus
+		self.bus.onReattach = self.reattached
+
 		self.width = width
 		self.height = height
+		self.state_file = state_file
+		self.addressing_mode = BusPirateSSD1306.MEM_ADDR_MODE_PAGE
 
 		self.cursor_column = 0
 		self.columns = int(self.width/8)
 		self.cursor_row = 0
 		self.rows = int(self.height/8)
 
+		# shadow of the configuration registers, commands which would not
+		# change the state of the controller are not sent again
+		self.registers = {}
+
+		# set while changes of the panel content are on their way, the state
+		# file claims no content until the outermost operation is through
+		self.dirty = False
+
+	def __getattr__(self, name):
+		# the display used to be a BusPirateI2C, attributes like serial,
+		# i2c_write() or command() are still reached through the bus
+		if name == 'bus':
+			raise AttributeError(name)
+		return getattr(self.bus, name)
+
+	def debug(self, msg):
+		self.bus.debug(msg)
+
+	def setDebugMode(self, enable=True):
+		self.bus.setDebugMode(enable)
+
+	def setRecorder(self, recorder):
+		self.bus.setRecorder(recorder)
+
+	@contextlib.contextmanager
+	def operation(self, operation):
+		try:
+			with self.bus.operation(operation):
+				yield
+		except BaseException:
+			# queued writes may have been dropped, the state of the panel is unknown
+			self.invalidate()
+			self.dirty = False
+			self.saveState()
+			raise
+
+		if self.dirty and len(self.bus.operations) == 0:
+			# everything has been flushed, the panel matches the shadow again
+			self.dirty = False
+			self.saveState()
+
+	def markDirty(self):
+		# a crash while the content is sent must not leave a state file which
+		# claims the old content
+		if self.dirty:
+			return
+		self.dirty = True
+		self.saveState()
+
+	def flush(self):
+		self.bus.flush()
+
+	def invalidate(self):
+		self.registers = {}
+
+	def getState(self):
+		return {'registers': self.registers}
+
+	def setState(self, state):
+		self.registers = state.get('registers', {})
+
+	def saveState(self):
+		if self.state_file == None:
+			return
+
+		tmp = self.state_file + '.tmp'
+		with open(tmp, 'w') as f:
+			json.dump(self.getState(), f)
+		os.replace(tmp, self.state_file)
+
+	def loadState(self):
+		if self.state_file == None or not os.path.exists(self.state_file):
+			return False
+
+		with open(self.state_file, 'r') as f:
+			self.setState(json.load(f))
+		return True
+
+	def getRegister(self, register):
+		return self.registers.get(register)
+
 	def setClockDiv(self, div):
-		self.ssd1306_cmd(0xd5)
-		self.ssd1306_cmd(div)
+		self.ssd1306_register('clockdiv', [0xd5, div])
 
 	def setMultiplexRatio(self, ratio):
-		self.ssd1306_cmd(0xa8)
-		self.ssd1306_cmd(ratio)
-
-	def setDisplayOffset(self, offset):
-		self.ssd1306_cmd(0xd3)
-		self.ssd1306_cmd(offset)
+		self.ssd1306_register('multiplex', [0xa8, ratio])
 
 	def setMemoryAddressingMode(self, mode):
-		self.ssd1306_cmd(0x20)
-		self.ssd1306_cmd(mode)
+		self.ssd1306_register('addressing', [0x20, mode])
 
 	def setContrast(self, contrast=0x7F):
-		self.ssd1306_cmd(0x81)
-		self.ssd1306_cmd(contrast)
+		self.ssd1306_register('contrast', [0x81, contrast])
 
 	def setPrechargePeriod(self, period):
-		self.ssd1306_cmd(0xd9)
-		self.ssd1306_cmd(period)
+		self.ssd1306_register('precharge', [0xd9, period])
 
 	def setVCOMHDeselectLevel(self, level):
-		self.ssd1306_cmd(0xdb)
-		self.ssd1306_cmd(level)
+		self.ssd1306_register('vcomh', [0xdb, level])
 
 	def setInverse(self, one_means_on=False):
 		if one_means_on == True:
-			self.ssd1306_cmd(0xA6)
+			self.ssd1306_register('inverse', [0xA6])
 		else:
-			self.ssd1306_cmd(0xA7)
+			self.ssd1306_register('inverse', [0xA7])
 
 	def setEnableRamOutput(self, ignoreram=False):
-		self.ssd1306_cmd(0xA4 + (ignoreram == True)*0x01)
+		self.ssd1306_register('ramoutput', [0xA4 + (ignoreram == True)*0x01])
 
 	def setColumnStartAddress(self, start):
 		l = start & 0x0F
 		h = (start & 0xF0) >> 4
-		self.ssd1306_cmd(0x00 | l)
-		self.ssd1306_cmd(0x10 | h)
+		self.ssd1306_cmds([0x00 | l, 0x10 | h])
 
 	def setColumnStartEnd(self, start=0x00, end=0x7F):
-		self.ssd1306_cmd(0x21)
-		self.ssd1306_cmd(start & 0x7F)
-		self.ssd1306_cmd(end & 0x7F)
+		self.ssd1306_cmds([0x21, start & 0x7F, end & 0x7F])
 
 	def setPageStartEnd(self, start=0x00, end=0x07):
-		self.ssd1306_cmd(0x22)
-		self.ssd1306_cmd(start & 0x07)
-		self.ssd1306_cmd(end & 0x07)
+		self.ssd1306_cmds([0x22, start & 0x07, end & 0x07])
 
 	def setPageStartAddress(self, start):
 		self.debug('New page start address %i' % start)
@@ -681,34 +1169,31 @@ class BusPirateSSD1306(BusPirateI2C):
 	
 	def setDisplayStartLine(self, line):
 		d = (line & 0x1F) | 0x40
-		self.ssd1306_cmd(d)
+		self.ssd1306_register('startline', [d])
 
 	def setDisplayOffset(self, offset):
-		self.ssd1306_cmd(0xd3)
-		self.ssd1306_cmd(offset & 0x3F)
+		self.ssd1306_register('offset', [0xd3, offset & 0x3F])
 
 	def setScroll(self, activate=True):
-		self.ssd1306_cmd(0x2E + (activate == True)*1)
+		self.ssd1306_register('scroll', [0x2E + (activate == True)*1])
 
 	def setChargePump(self, enabled):
-		self.ssd1306_cmd(0x8D)
-		self.ssd1306_cmd(0x10 + (enabled == True)*0x04)
+		self.ssd1306_register('chargepump', [0x8D, 0x10 + (enabled == True)*0x04])
 
 	def setCOMPinConfiguration(self, sequential, leftrightremap):
 		d  = 0x02
 		d |= (sequential == True)*0x10
 		d |= (leftrightremap == True)*0x20
-		self.ssd1306_cmd(0xda)
-		self.ssd1306_cmd(d)
+		self.ssd1306_register('compins', [0xda, d])
 
 	def setSegmentRemap(self, lefttoright):
-		self.ssd1306_cmd(0xA0 + (lefttoright == True)*0x01)
+		self.ssd1306_register('segmentremap', [0xA0 + (lefttoright == True)*0x01])
 
 	def setCOMOutputScanDirection(self, normal):
-		self.ssd1306_cmd(0xC0 + (normal == False)*0x08)
+		self.ssd1306_register('comscan', [0xC0 + (normal == False)*0x08])
 
 	def setDisplayPower(self, on):
-		self.ssd1306_cmd(0xAE + (on == True)*1)
+		self.ssd1306_register('power', [0xAE + (on == True)*1])
 
 	def setCursorPosition(self, x, y):
 		self.cursor_column = x % self.columns
@@ -718,27 +1203,41 @@ class BusPirateSSD1306(BusPirateI2C):
 		return (self.cursor_column, self.cursor_row)
 
 	def print(self, msg, vertical=False):
-		self.setColumnStartEnd(0, self.width-1)
-		self.setPageStartEnd(0, self.rows-1)
-		self.setColumnStartAddress(self.cursor_column*8)
-		self.setPageStartAddress(self.cursor_row)
-
-		for char in msg:
-			if vertical == False:
-				self.ssd1306_ctrl(BusPirateSSD1306.ASCII_TABLE_HORIZONTAL[ord(char)])
-			else:
-				self.ssd1306_ctrl(BusPirateSSD1306.ASCII_TABLE_VERTICAL[ord(char)])
-
-			self.cursor_column += 1
-			if self.cursor_column >= self.columns:
-				self.cursor_column = 0
-				self.cursor_row += 1
+		with self.operation('print'):
+			self.setMemoryAddressingMode(BusPirateSSD1306.MEM_ADDR_MODE_PAGE)
+			self.setColumnStartEnd(0, self.width-1)
+			self.setPageStartEnd(0, self.rows-1)
+			self.setColumnStartAddress(self.cursor_column*8)
+			self.setPageStartAddress(self.cursor_row)
+
+			for char in msg:
+				if vertical == False:
+					self.ssd1306_ctrl(BusPirateSSD1306.ASCII_TABLE_HORIZONTAL[ord(char)])
+				else:
+					self.ssd1306_ctrl(BusPirateSSD1306.ASCII_TABLE_VERTICAL[ord(char)])
+
+				self.cursor_column += 1
+				if self.cursor_column >= self.columns:
+					self.cursor_column = 0
+					self.cursor_row += 1
 		
-		self.cursor_column %= self.columns
-		self.cursor_row %= self.rows
+			self.cursor_column %= self.columns
+			self.cursor_row %= self.rows
 
 		return self.getCursorPosition()
 		
+	def writeColumns(self, x, page, width, pages, data, block=None):
+		# data holds the pages of each column one after another
+		if block == None:
+			block = self.bus.block_size
+
+		with self.operation('columns'):
+			self.setMemoryAddressingMode(BusPirateSSD1306.MEM_ADDR_MODE_VERT)
+			self.setColumnStartEnd(x, x+width-1)
+			self.setPageStartEnd(page, page+pages-1)
+			for idx in range(0, len(data), block):
+				self.ssd1306_ctrl(data[idx:idx+block])
+
 	def println(self, msg, vertical=False):
 		self.print(msg, vertical)
 		self.cursor_column = 0
@@ -746,8 +1245,36 @@ class BusPirateSSD1306(BusPirateI2C):
 		return self.getCursorPosition()
 
 	def init(self):
-		BusPirateI2C.init(self)
-		self.setDisplayPower(False)
+		# the mode setup of the bus may cut the supply of the panel, only
+		# resume() keeps the shadow of a session which survived
+		with self.operation('init'):
+			self.invalidate()
+			self.bus.init()
+			self.configure()
+
+	def reattached(self, kept):
+		if kept:
+			return
+
+		# the Bus Pirate lost its mode and with it the supply of the panel
+		self.invalidate()
+		self.configure()
+
+	def resume(self):
+		# returns whether the panel kept its session, its RAM is random otherwise
+		with self.operation('resume'):
+			kept = self.loadState() and len(self.registers) > 0
+			if not self.bus.reattach():
+				self.invalidate()
+				kept = False
+			self.configure()
+		return kept
+
+	def configure(self):
+		# a panel which is already known to be running is reconfigured
+		# without switching it off
+		if self.getRegister('power') == None:
+			self.setDisplayPower(False)
 		self.setClockDiv(0x80)
 		self.setMultiplexRatio(0x3f)
 		self.setChargePump(True)
@@ -756,7 +1283,7 @@ class BusPirateSSD1306(BusPirateI2C):
 		self.setVCOMHDeselectLevel(0x40)
 		self.setInverse(True)
 
-		self.setMemoryAddressingMode(BusPirateSSD1306.MEM_ADDR_MODE_PAGE)
+		self.setMemoryAddressingMode(self.addressing_mode)
 		self.setSegmentRemap(True)
 		self.setCOMOutputScanDirection(False)
 		self.setCOMPinConfiguration(True, False)
@@ -767,32 +1294,90 @@ class BusPirateSSD1306(BusPirateI2C):
 
 		self.setEnableRamOutput()
 		self.setDisplayPower(True)
+		self.saveState()
 
 	def clear(self):
-		self.ssd1306_ctrl('0x00:1024')
-		sleep(0.5)
+		with self.operation('clear'):
+			self.ssd1306_ctrl([0x00]*self.width*self.rows)
+			sleep(0.5)
 	
 	def fill(self):
-		self.ssd1306_ctrl('0xFF:1024')
-		sleep(0.5)
+		with self.operation('fill'):
+			self.ssd1306_ctrl([0xFF]*self.width*self.rows)
+			sleep(0.5)
 
 	def ssd1306_cmd(self, command):
-		self.i2c_write([0x00, command])
+		self.bus.write_cmds([command])
+
+	def ssd1306_cmds(self, commands):
+		self.bus.write_cmds(commands)
+
+	def ssd1306_register(self, register, commands):
+		if self.registers.get(register) == commands:
+			self.debug('ssd1306: %s unchanged' % (register))
+			return
+
+		self.bus.write_cmds(commands)
+		self.registers[register] = commands
+
+		if len(self.bus.operations) == 0:
+			self.saveState()
 
 	def ssd1306_ctrl(self, control):
 		if type(control) == list:
-			self.i2c_write([0x40] + control)
+			self.bus.write_data(control)
 		else:
-			self.i2c_write([0x40, control])
+			self.bus.write_data([control])
 
 class BusPirateSSD1306Buffered(BusPirateSSD1306):
-	def __init__(self, device, baud, i2c_addr=0x78, width=128, height=64):
-		BusPirateSSD1306.__init__(self, device=device, baud=baud, i2c_addr=i2c_addr, i2c_freq=4, width=width, height=height)
+	# a row byte of a packed frame (MSB left) spread over bit 0 of 8 column bytes
+	FRAME_SPREAD = [sum(((v >> (7-c)) & 0x01) << (c*8) for c in range(0, 8)) for v in range(0, 256)]
+
+	def __init__(self, device=None, baud=115200, i2c_addr=0x78, width=128, height=64, state_file=None, bus=None):
+		BusPirateSSD1306.__init__(self, device=device, baud=baud, i2c_addr=i2c_addr, i2c_freq=4, width=width, height=height, state_file=state_file, bus=bus)
 		self.buffer = [0x00]*self.width*int(self.height/8)
+		self.addressing_mode = BusPirateSSD1306.MEM_ADDR_MODE_HORZ
+
+		# named off-screen framebuffers, drawing goes into the selected one,
+		# sync() sends the visible one
+		self.screens = {'default': self.buffer}
+		self.selected = 'default'
+		self.visible = 'default'
+
+		# copy of the display RAM, None while the content of the panel is unknown
+		self.glass = None
+		self.generation = 0
+
+		self.sprites = {}
 
 	def init(self):
 		BusPirateSSD1306.init(self)
 
+	def invalidate(self):
+		BusPirateSSD1306.invalidate(self)
+		self.glass = None
+		self.generation += 1
+
+	def getState(self):
+		state = BusPirateSSD1306.getState(self)
+		if self.glass != None and not self.dirty:
+			state['glass'] = bytes(self.glass).hex()
+		return state
+
+	def setState(self, state):
+		BusPirateSSD1306.setState(self, state)
+		self.glass = None
+		if 'glass' in state:
+			glass = list(bytes.fromhex(state['glass']))
+			if len(glass) == len(self.buffer):
+				self.glass = glass
+				self.screens[self.visible][:] = glass
+
+	def resume(self):
+		kept = BusPirateSSD1306.resume(self)
+		self.sync()
+		return kept
+
 	def setPixel(self, x, y, value=0x01):
 		ox = int(x) % self.width
 		oy = int(y/8) % self.height
@@ -805,58 +1390,283 @@ class BusPirateSSD1306Buffered(BusPirateSSD1306):
 		else:
 			self.buffer[off] |= (0x01 << cv)
 
-	def clear(self):
-		self.buffer = [0x00]*self.width*int(self.height/8)
-		BusPirateSSD1306.clear(self)
+	def writeColumns(self, x, page, width, pages, data, block=None):
+		with self.operation('columns'):
+			self.markDirty()
+			BusPirateSSD1306.writeColumns(self, x, page, width, pages, data, block)
+
+			# keep the visible screen and the glass in step with the panel
+			frame = self.screens[self.visible]
+			for c in range(0, width):
+				for p in range(0, pages):
+					off = (page+p)*self.width+x+c
+					frame[off] = data[c*pages+p]
+					if self.glass != None:
+						self.glass[off] = data[c*pages+p]
+
+	def setFrame(self, frame, depth=1, threshold=128):
+		# frame is row-major, either packed 1 bit (MSB left, 1 = pixel on)
+		# or 8 bit gray which is thresholded
+		if depth == 8:
+			table = bytes(0x30 + (v >= threshold) for v in range(0, 256))
+			frame = int(bytes(frame).translate(table), 2).to_bytes(len(frame)//8, 'big')
+
+		spread = BusPirateSSD1306Buffered.FRAME_SPREAD
+		stride = self.width//8
+		for page in range(0, self.rows):
+			rows = [frame[(page*8+r)*stride:(page*8+r+1)*stride] for r in range(0, 8)]
+			for bx in range(0, stride):
+				v = 0
+				for r in range(0, 8):
+					v |= spread[rows[r][bx]] << r
+				off = page*self.width+bx*8
+				self.buffer[off:off+8] = v.to_bytes(8, 'little')
+
+	def getSprite(self, bitmap):
+		if isinstance(bitmap, Sprite):
+			return bitmap
+
+		key = tuple(tuple(page) if type(page) != int else page for page in bitmap)
+		if key not in self.sprites:
+			self.sprites[key] = Sprite(bitmap)
+		return self.sprites[key]
+
+	def blit(self, x, y, bitmap, opaque=False):
+		sprite = self.getSprite(bitmap)
+		x = int(x)
+		y = int(y)
+
+		start = max(0, x)
+		end = min(self.width, x+sprite.width)
+		if start >= end:
+			return
+
+		rows = sprite.shifted[y % 8]
+		masks = sprite.masks[y % 8]
+		for (r, row) in enumerate(rows):
+			page = y//8 + r
+			if page < 0 or page >= self.rows:
+				continue
+
+			off = page*self.width
+			src = row[start-x:end-x]
+			dst = self.buffer[off+start:off+end]
+			if opaque:
+				keep = 0xFF ^ masks[r]
+				self.buffer[off+start:off+end] = [(d & keep) | s for (d, s) in zip(dst, src)]
+			else:
+				self.buffer[off+start:off+end] = [d | s for (d, s) in zip(dst, src)]
 
-	def fill(self):
-		self.buffer = [0xff]*self.width*int(self.height/8)
+	def blitText(self, x, y, msg, opaque=True):
+		for char in msg:
+			self.blit(x, y, BusPirateSSD1306.ASCII_TABLE_HORIZONTAL[ord(char)], opaque)
+			x += 8
+
+	def addScreen(self, name, copy=None):
+		if name in self.screens:
+			raise ValueError('Screen %s exists already' % (name))
+		if copy == None:
+			self.screens[name] = [0x00]*self.width*int(self.height/8)
+		else:
+			self.screens[name] = list(self.screens[copy])
+
+	def removeScreen(self, name):
+		if name == self.selected or name == self.visible:
+			raise ValueError('Screen %s is in use' % (name))
+		del self.screens[name]
+
+	def selectScreen(self, name):
+		self.buffer = self.screens[name]
+		self.selected = name
+
+	def show(self, name):
+		if name not in self.screens:
+			raise KeyError(name)
+		self.visible = name
 		self.sync()
-		#BusPirateSSD1306Buffered.fill(self)
 
-	def sync(self, block=16):
-		self.setColumnStartEnd(0x00, 0x7f)
-		self.setPageStartEnd(0x00, 0x07)
+	def print(self, msg, vertical=False):
+		# text is drawn into the framebuffer, writing it straight to the panel
+		# would leave the glass behind
+		if vertical == False:
+			table = BusPirateSSD1306.ASCII_TABLE_HORIZONTAL
+		else:
+			table = BusPirateSSD1306.ASCII_TABLE_VERTICAL
 
-		idx = 0
-		while idx < self.width*self.height/8:
-			d = []
-			for j in range(0, block):
-				d += [self.buffer[idx]]
-				idx += 1
+		with self.operation('print'):
+			for char in msg:
+				self.blit(self.cursor_column*8, (self.cursor_row % self.rows)*8, table[ord(char)], opaque=True)
 
-			self.i2c_write([0x40] + d)
+				self.cursor_column += 1
+				if self.cursor_column >= self.columns:
+					self.cursor_column = 0
+					self.cursor_row += 1
 
+			self.cursor_column %= self.columns
+			self.cursor_row %= self.rows
+			if self.selected == self.visible:
+				self.sync()
 
-if __name__ == "buspirate_SSD1306":
-	import psutil, sys
-	from datetime import datetime
-	d = BusPirateSSD1306(device=sys.argv[1], baud=115200)
-	d.init()
-	d.clear()
-	
-	d.setCursorPosition(0, 2)
-	d.println('CPU:')
-	d.println('MEM:')
-
-	d.setCursorPosition(0, 5)
-	d.println('Net stats in MB')
-	d.println('Snt:')
-	d.println('Rcv:')
-
-	while True:
-		d.setCursorPosition(0, 0)
-		d.println(datetime.now().strftime('%Y/%m/%d'))
-		d.println(datetime.now().strftime('%H:%M:%S'))
-
-		d.setCursorPosition(5, 2)
-		d.print('%3.1f  ' % (psutil.cpu_percent()))
-		d.setCursorPosition(5, 3)
-		d.print('%3.1f  ' % (psutil.virtual_memory().percent))
-
-		d.setCursorPosition(5, 6)
-		d.print('%i  ' % (psutil.net_io_counters().bytes_sent/1048576))
-		d.setCursorPosition(5, 7)
-		d.print('%i  ' % (psutil.net_io_counters().bytes_recv/1048576))
+		return self.getCursorPosition()
+
+	def clear(self):
+		self.buffer[:] = [0x00]*self.width*int(self.height/8)
+		if self.selected != self.visible:
+			return
+		if self.glass != None:
+			self.sync()
+			return
+
+		with self.operation('clear'):
+			self.setMemoryAddressingMode(self.addressing_mode)
+			self.setColumnStartEnd(0, self.width-1)
+			self.setPageStartEnd(0, self.rows-1)
+			self.markDirty()
+			BusPirateSSD1306.clear(self)
+			self.glass = list(self.buffer)
 
+	def fill(self):
+		self.buffer[:] = [0xff]*self.width*int(self.height/8)
+		if self.selected == self.visible:
+			self.sync()
+		#BusPirateSSD1306Buffered.fill(self)
+
+	def getDirtyRegions(self, frame):
+		if self.glass == None:
+			return [(0, self.rows-1, 0, self.width-1)]
+
+		# changed column span of every page, neighboured pages are merged
+		# into one window to save the addressing commands
+		regions = []
+		for page in range(0, self.rows):
+			off = page*self.width
+			columns = [x for x in range(0, self.width) if frame[off+x] != self.glass[off+x]]
+			if len(columns) == 0:
+				continue
+
+			if len(regions) > 0 and regions[-1][1] == page-1:
+				(first, last, start, end) = regions[-1]
+				regions[-1] = (first, page, min(start, columns[0]), max(end, columns[-1]))
+			else:
+				regions += [(page, page, columns[0], columns[-1])]
+		return regions
+
+	def sync(self, block=None):
+		if block == None:
+			block = self.bus.block_size
+
+		with self.operation('sync'):
+			self.setMemoryAddressingMode(self.addressing_mode)
+
+			# a reconnect which loses the panel during the transfer invalidates
+			# the glass, the whole content is sent again in that case
+			frame = self.screens[self.visible]
+			generation = None
+			while generation != self.generation:
+				generation = self.generation
+				for (first, last, start, end) in self.getDirtyRegions(frame):
+					self.setColumnStartEnd(start, end)
+					self.setPageStartEnd(first, last)
+
+					d = []
+					for page in range(first, last+1):
+						d += frame[page*self.width+start:page*self.width+end+1]
+					self.markDirty()
+					for idx in range(0, len(d), block):
+						self.bus.write_data(d[idx:idx+block])
+
+					if generation != self.generation:
+						break
+
+					if self.glass == None:
+						self.glass = list(frame)
+					else:
+						for page in range(first, last+1):
+							off = page*self.width
+							self.glass[off+start:off+end+1] = frame[off+start:off+end+1]
+
+
+class Chart:
+	# Scrolling bar chart on a window of the display. The samples are kept in
+	# a ring, every new sample replaces the oldest column in place, a blank
+	# column in front of it marks the position of the ring.
+	def __init__(self, display, x=0, page=0, width=128, pages=8, minimum=0, maximum=100, cursor=True):
+		if maximum <= minimum:
+			raise ValueError('Maximum %r must be above minimum %r' % (maximum, minimum))
+		if x < 0 or width < 1 or x+width > display.width:
+			raise ValueError('Columns %i to %i are outside of the display' % (x, x+width-1))
+		if page < 0 or pages < 1 or page+pages > display.rows:
+			raise ValueError('Pages %i to %i are outside of the display' % (page, page+pages-1))
+
+		self.display = display
+		self.x = x
+		self.page = page
+		self.width = width
+		self.pages = pages
+		self.minimum = minimum
+		self.maximum = maximum
+		self.cursor = cursor
+
+		self.samples = collections.deque(maxlen=width)
+		self.head = 0
+
+		# pattern of every bar height, the pages of a column top to bottom
+		h = pages*8
+		self.strips = []
+		for height in range(0, h+1):
+			bits = ((1 << height) - 1) << (h - height)
+			self.strips += [[(bits >> (p*8)) & 0xFF for p in range(0, pages)]]
+		self.blank = self.strips[0]
+
+	def scale(self, values):
+		h = self.pages*8
+		factor = h / float(self.maximum - self.minimum)
+		return [min(h, max(0, int((v - self.minimum)*factor + 0.5))) for v in values]
+
+	def add(self, *values):
+		self.extend(values)
+
+	def extend(self, values):
+		values = list(values)[-self.width:]
+		heights = self.scale(values)
+		self.samples.extend(values)
+
+		columns = []
+		for height in heights:
+			columns += [(self.head, self.strips[height])]
+			self.head = (self.head + 1) % self.width
+		if self.cursor and len(heights) < self.width:
+			columns += [(self.head, self.blank)]
+
+		self.write(columns)
+
+	def redraw(self):
+		# the samples are scaled again, a changed minimum or maximum applies
+		# to the whole chart
+		columns = [(c, self.blank) for c in range(0, self.width)]
+		start = (self.head - len(self.samples)) % self.width
+		for (i, height) in enumerate(self.scale(self.samples)):
+			columns[(start + i) % self.width] = ((start + i) % self.width, self.strips[height])
+		if self.cursor:
+			columns[self.head] = (self.head, self.blank)
+		self.write(columns)
+
+	def write(self, columns):
+		# columns in ascending order are sent as one window, a wrap of the
+		# ring starts a new one
+		with self.display.operation('chart'):
+			run = []
+			for (c, strip) in columns:
+				if len(run) > 0 and c != run[-1][0] + 1:
+					self.writeRun(run)
+					run = []
+				run += [(c, strip)]
+			if len(run) > 0:
+				self.writeRun(run)
+
+	def writeRun(self, run):
+		data = []
+		for (c, strip) in run:
+			data += strip
+		self.display.writeColumns(self.x + run[0][0], self.page, len(run), self.pages, data)
 
@@ -0,0 +1,260 @@
+# vim: noet shiftwidth=4 tabstop=4
+
+# Copyright (c) 2016 Alexander Böhm <alxndr.boehm@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import argparse, sys, threading
+from time import time
+
+from . import BusPirateI2C, BusPirateSPI, LinuxI2C, BusPirateSSD1306, BusPirateSSD1306Buffered
+
+def openDisplay(args, buffered=True):
+	if args.i2c_dev != None:
+		bus = LinuxI2C(bus=args.i2c_dev, i2c_addr=args.address if args.address != None else 0x3C)
+	elif args.spi:
+		bus = BusPirateSPI(device=args.device, baud=args.baud, spi_speed=args.spi_speed)
+	else:
+		bus = BusPirateI2C(device=args.device, baud=args.baud, i2c_addr=args.address if args.address != None else 0x78, i2c_freq=4)
+	bus.setDebugMode(args.debug)
+
+	if buffered:
+		d = BusPirateSSD1306Buffered(width=args.width, height=args.height, state_file=args.state_file, bus=bus)
+	else:
+		d = BusPirateSSD1306(width=args.width, height=args.height, state_file=args.state_file, bus=bus)
+
+	if args.resume:
+		# the buffered display sends its whole frame anyway when the panel
+		# was lost, the plain one only draws over what is there
+		if not d.resume() and not buffered:
+			d.clear()
+	else:
+		d.init()
+		d.clear()
+	return d
+
+def readFrame(source, size):
+	frame = b''
+	while len(frame) < size:
+		d = source.read(size - len(frame))
+		if len(d) == 0:
+			return None
+		frame += d
+	return frame
+
+def readImage(path, d, depth):
+	if path == '-':
+		data = sys.stdin.buffer.read()
+	else:
+		with open(path, 'rb') as f:
+			data = f.read()
+
+	# PBM (P4) images are accepted besides raw frames, a set bit lights the pixel
+	if data[:2] == b'P4':
+		fields = []
+		idx = 2
+		while len(fields) < 2:
+			while data[idx:idx+1].isspace():
+				idx += 1
+			if data[idx:idx+1] == b'#':
+				idx = data.index(b'\n', idx)
+				continue
+			start = idx
+			while not data[idx:idx+1].isspace():
+				idx += 1
+			fields += [int(data[start:idx])]
+		if fields != [d.width, d.height]:
+			raise ValueError('Image is %ix%i, display is %ix%i' % (fields[0], fields[1], d.width, d.height))
+		data = data[idx+1:]
+		depth = 1
+
+	size = d.width*d.height*depth//8
+	if len(data) != size:
+		raise ValueError('Image has %i bytes, a %ix%i frame of %i bit needs %i' % (len(data), d.width, d.height, depth, size))
+	return (data, depth)
+
+def dashboard(args):
+	import psutil
+	from datetime import datetime
+
+	if args.device_arg != None:
+		args.device = args.device_arg
+	d = openDisplay(args, buffered=False)
+
+	d.setCursorPosition(0, 2)
+	d.println('CPU:')
+	d.println('MEM:')
+
+	d.setCursorPosition(0, 5)
+	d.println('Net stats in MB')
+	d.println('Snt:')
+	d.println('Rcv:')
+
+	while True:
+		d.setCursorPosition(0, 0)
+		d.println(datetime.now().strftime('%Y/%m/%d'))
+		d.println(datetime.now().strftime('%H:%M:%S'))
+
+		d.setCursorPosition(5, 2)
+		d.print('%3.1f  ' % (psutil.cpu_percent()))
+		d.setCursorPosition(5, 3)
+		d.print('%3.1f  ' % (psutil.virtual_memory().percent))
+
+		d.setCursorPosition(5, 6)
+		d.print('%i  ' % (psutil.net_io_counters().bytes_sent/1048576))
+		d.setCursorPosition(5, 7)
+		d.print('%i  ' % (psutil.net_io_counters().bytes_recv/1048576))
+
+def stream(args):
+	d = openDisplay(args)
+	d.bus.bytes_written = 0
+	size = d.width*d.height*args.depth//8
+
+	# the reader keeps only the newest frame, frames arriving while the
+	# display is busy are dropped
+	latest = {'frame': None, 'count': 0, 'eof': False}
+	ready = threading.Condition()
+
+	def reader():
+		while True:
+			frame = readFrame(sys.stdin.buffer, size)
+			with ready:
+				if frame == None:
+					latest['eof'] = True
+				else:
+					latest['frame'] = frame
+					latest['count'] += 1
+				ready.notify()
+			if frame == None:
+				return
+
+	threading.Thread(target=reader, daemon=True).start()
+
+	shown = 0
+	dropped = 0
+	last = 0
+	start = time()
+	while True:
+		with ready:
+			while latest['frame'] == None and not latest['eof']:
+				ready.wait()
+			frame = latest['frame']
+			count = latest['count']
+			latest['frame'] = None
+		if frame == None:
+			break
+
+		dropped += count - last - 1
+		last = count
+		d.setFrame(frame, args.depth, args.threshold)
+		d.sync()
+		shown += 1
+
+	elapsed = max(time() - start, 1e-9)
+	sys.stderr.write('%i frames shown, %i dropped, %.2f fps, %.1f bytes/frame\n' % (
+		shown, dropped, shown/elapsed, d.bus.bytes_written/float(max(shown, 1))))
+
+def push(args):
+	d = openDisplay(args)
+	if args.image != None:
+		(frame, depth) = readImage(args.image, d, args.depth)
+		d.setFrame(frame, depth, args.threshold)
+	for (i, line) in enumerate(args.text):
+		d.blitText(args.x, args.y + i*8, line)
+	d.sync()
+
+def bench(args):
+	d = openDisplay(args)
+	glyph = BusPirateSSD1306.ASCII_TABLE_HORIZONTAL[0x02]
+	blank = [0x00]*len(d.buffer)
+
+	def full(i):
+		d.buffer[:] = [(0x55, 0xAA)[(i + x) % 2] for x in range(0, len(d.buffer))]
+
+	def sprite(i):
+		d.buffer[:] = blank
+		d.blit((i*3) % (d.width-8), (i*5) % (d.height-8), glyph)
+
+	patterns = {'full': full, 'sprite': sprite}
+	for name in args.pattern:
+		d.bus.bytes_written = 0
+		start = time()
+		for i in range(0, args.frames):
+			patterns[name](i)
+			d.sync()
+		elapsed = max(time() - start, 1e-9)
+		print('%-8s %8.2f fps %10.1f bytes/frame' % (name, args.frames/elapsed, d.bus.bytes_written/float(args.frames)))
+
+def main(argv):
+	common = argparse.ArgumentParser(add_help=False)
+	common.add_argument('--device', default='/dev/ttyUSB0', help='serial device of the Bus Pirate')
+	common.add_argument('--baud', type=int, default=115200)
+	common.add_argument('--spi', action='store_true', help='panel is wired for SPI')
+	common.add_argument('--spi-speed', type=int, default=4, help='entry of the Bus Pirate SPI speed menu')
+	common.add_argument('--i2c-dev', type=int, default=None, metavar='N', help='use /dev/i2c-N instead of a Bus Pirate')
+	common.add_argument('--address', type=lambda v: int(v, 0), default=None, help='I2C address of the panel')
+	common.add_argument('--width', type=int, default=128)
+	common.add_argument('--height', type=int, default=64)
+	common.add_argument('--state-file', default=None, help='persist registers and frame for --resume')
+	common.add_argument('--resume', action='store_true', help='resume a running panel instead of init and clear')
+	common.add_argument('--debug', action='store_true')
+
+	frames = argparse.ArgumentParser(add_help=False)
+	frames.add_argument('--depth', type=int, choices=[1, 8], default=1, help='bits per pixel of raw frames')
+	frames.add_argument('--threshold', type=int, default=128, help='gray level lighting a pixel of 8 bit frames')
+
+	parser = argparse.ArgumentParser(prog='python -m buspirate_SSD1306')
+	commands = parser.add_subparsers(dest='command')
+
+	p = commands.add_parser('dashboard', parents=[common], help='show system statistics')
+	p.add_argument('device_arg', nargs='?', default=None, metavar='DEVICE')
+	p.set_defaults(run=dashboard)
+
+	p = commands.add_parser('stream', parents=[common, frames], help='show raw frames read from stdin')
+	p.set_defaults(run=stream)
+
+	p = commands.add_parser('push', parents=[common, frames], help='show an image and/or text once')
+	p.add_argument('--image', default=None, help='PBM or raw frame, - for stdin')
+	p.add_argument('--text', action='append', default=[], help='line of text, may be given several times')
+	p.add_argument('--x', type=int, default=0)
+	p.add_argument('--y', type=int, default=0)
+	p.set_defaults(run=push)
+
+	p = commands.add_parser('bench', parents=[common], help='measure frame rate and bytes per frame')
+	p.add_argument('--frames', type=int, default=20)
+	p.add_argument('--pattern', action='append', choices=['full', 'sprite'], default=None)
+	p.set_defaults(run=bench)
+
+	# the former invocation with only a device runs the dashboard
+	if len(argv) > 0 and argv[0] not in commands.choices and not argv[0].startswith('-'):
+		argv = ['dashboard'] + argv
+
+	args = parser.parse_args(argv)
+	if args.command == None:
+		parser.print_help()
+		return 1
+	if args.command == 'bench' and args.pattern == None:
+		args.pattern = ['full', 'sprite']
+
+	args.run(args)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))